@@ -2,7 +2,7 @@
 I/O functions for XYZ files (currently, only able to read such files)
 """
 
-from typing import Iterable, Tuple
+from typing import Iterable, List, Tuple
 
 import numpy as np
 
@@ -37,18 +37,84 @@ def read_xyz(xyz_file: Iterable) -> Tuple[Tuple[np.ndarray, np.ndarray, np.ndarr
             - an 1-D for their radii
         The second element is a 3x3 matrix with the lattice vectors (one row per vector)
     """
-    kinds, centers, radii = [], [], []
-    vectors = []
-
+    vector_lines, atom_lines = [], []
     for line in xyz_file:
         line = line.strip()
         if line.startswith('lattice_vector'):
-            vectors.append(np.array(list(map(float, line.split()[1:]))))
+            vector_lines.append(line)
         elif line.startswith('atom'):
-            # pylint: disable=invalid-name
-            _, x, y, z, kind = line.split()
-            kinds.append(kind)
-            centers.append([float(x), float(y), float(z)])
-            radii.append(VDW_RADII[kind])
+            atom_lines.append(line)
+
+    # The fields are split at once, and the numbers are converted in bulk by NumPy when
+    # filling the (preallocated) arrays, column by column
+    vector_fields = _split_fields(vector_lines, 4)
+    vectors = np.empty((len(vector_lines), 3))
+    for column in range(3):
+        vectors[:, column] = vector_fields[column + 1::4]
+
+    atom_fields = _split_fields(atom_lines, 5)
+    centers = np.empty((len(atom_lines), 3))
+    for column in range(3):
+        centers[:, column] = atom_fields[column + 1::5]
+    kinds = np.array(atom_fields[4::5], dtype=str)
+    radii = _lookup_radii(kinds)
+
+    return (kinds, centers, radii), vectors
+
+
+def _lookup_radii(kinds: np.ndarray) -> np.ndarray:
+    """
+    Finds the VDW radius of each atom. Instead of looking up `VDW_RADII` atom by atom, the
+    kinds are located in the (few) known ones with a binary search, which gives the indices
+    of their radii
+
+    Parameters
+    ----------
+    kinds: np.ndarray
+        Kinds of the atoms
+
+    Returns
+    -------
+    np.ndarray
+        Radii of the atoms
 
-    return (np.array(kinds), np.array(centers), np.array(radii)), np.array(vectors)
+    Raises
+    ------
+    KeyError
+        If a kind is not in `VDW_RADII`
+    """
+    known_kinds = np.array(sorted(VDW_RADII), dtype=str)
+    known_radii = np.array([VDW_RADII[kind] for kind in known_kinds])
+
+    indices = np.minimum(np.searchsorted(known_kinds, kinds), len(known_kinds) - 1)
+    unknown = known_kinds[indices] != kinds
+    if unknown.any():
+        raise KeyError(str(kinds[unknown][0]))
+    return known_radii[indices]
+
+
+def _split_fields(lines: List[str], n_fields: int) -> List[str]:
+    """
+    Splits lines made of whitespace-separated fields into a flat list of fields
+
+    Parameters
+    ----------
+    lines: List[str]
+        The lines to split
+    n_fields: int
+        Number of fields in each line
+
+    Returns
+    -------
+    List[str]
+        The fields of all the lines, line after line
+
+    Raises
+    ------
+    ValueError
+        If the lines do not have the expected number of fields
+    """
+    fields = ' '.join(lines).split()
+    if len(fields) != n_fields * len(lines):
+        raise ValueError(f'Malformed XYZ data: expected {n_fields} fields per line')
+    return fields
@@ -4,9 +4,31 @@ This method counts the number of atoms that contain the center of each voxel
 
 from typing import List, Tuple
 import itertools as it
+import math
+import threading
 
 import numpy as np
 
+try:
+    from numba import cuda, njit, prange
+    HAS_NUMBA = True
+    HAS_CUDA = cuda.is_available()
+except ImportError:  # pragma: no cover
+    HAS_NUMBA = False
+    HAS_CUDA = False
+
+
+CUDA_BLOCK_SHAPE = (8, 8, 8)
+"""Number of threads (one per voxel) in each direction of a CUDA block"""
+
+
+_KERNEL_LOCK = threading.Lock()
+"""
+Serializes the calls of the compiled kernels: Streamlit runs each session in its own thread, and
+the `workqueue` threading layer of Numba (its fallback without TBB or OpenMP) aborts the process
+when two threads call a parallel function concurrently (nor is the CUDA simulator thread-safe)
+"""
+
 
 def get_voxels(
     atoms: Tuple[np.ndarray, np.ndarray, np.ndarray],
@@ -37,44 +59,386 @@ def get_voxels(
     Returns
     -------
     np.ndarray
-        An array of voxels
+        An array of voxels (integer counts)
     """
-    voxels = np.zeros((resolution, resolution, resolution))
-
     # The atoms must be repeated once, because some of the neigbouring cells may overlap the
     # unit one, if the radii are big. By repeating only once, we assume no atom spans more
     # than the dimension of a unit cell
-    # The radii are squared beforehand to avoid doing it inside the loop
     centers, radii = repeat_once(atoms, vectors)
+
+    # The atoms are then sorted into buckets, so that each voxel is only tested against
+    # the atoms of the neighbouring buckets
+    centers, radii, grid_origin, bucket_size, grid_shape, bucket_starts = hash_atoms(
+        centers, radii, vectors
+    )
+    # The radii are squared beforehand to avoid doing it inside the loop
     squared_radii: np.ndarray = radii**2
 
     transfer_matrix = np.linalg.inv(vectors).T
 
-    x_range = np.linspace(0, x_max, num=resolution, endpoint=False) + x_max / (2*resolution)
-    y_range = np.linspace(0, y_max, num=resolution, endpoint=False) + x_max / (2*resolution)
-    z_range = np.linspace(0, z_max, num=resolution, endpoint=False) + x_max / (2*resolution)
+    # The voxel (k, j, i) of the array has its center at M = (x_range[i], y_range[j], z_range[k])
+    # ("real-world" coordinates), where the ranges hold the centers of the voxels on each axis.
+    # Since M_lattice = transfer_matrix @ M is linear, its value is the sum of the contributions
+    # of x, y and z, that are computed once per axis instead of doing a matrix product per voxel
+    x_lattice, y_lattice, z_lattice = (
+        np.outer(
+            np.linspace(0, axis_max, num=resolution, endpoint=False) + axis_max / (2*resolution),
+            transfer_matrix[:, axis]
+        )
+        for axis, axis_max in enumerate((x_max, y_max, z_max))
+    )
+
+    # The setup above is done in double precision, but the lookup itself does not need it (the
+    # coordinates and radii are a few angstroms): single precision halves the memory traffic
+    # and doubles the width of the SIMD instructions.
+    # The centers are also transposed (one row per coordinate) so that the loops on the atoms
+    # read each coordinate from contiguous memory
+    centers = centers.T
+
+    if HAS_NUMBA:
+        kernel_arguments = (
+            _as_float32(x_lattice), _as_float32(y_lattice), _as_float32(z_lattice),
+            _as_float32(vectors.T),
+            _as_float32(centers), _as_float32(squared_radii),
+            _as_float32(grid_origin), np.float32(bucket_size), grid_shape, bucket_starts
+        )
+
+        with _KERNEL_LOCK:
+            if HAS_CUDA:
+                return _lookup_voxels_cuda(*kernel_arguments)
+
+            # Counts are small integers
+            voxels = np.zeros((resolution, resolution, resolution), dtype=np.int16, order='C')
+            _lookup_voxels_kernel(*kernel_arguments, voxels)
+            return voxels
 
-    M = np.zeros(3)
-    for i, x in enumerate(x_range):
-        M[0] = x
-        for j, y in enumerate(y_range):
-            M[1] = y
-            for k, z in enumerate(z_range):
-                M[2] = z
-                # M is the center of the voxel in the [x_max, y_max, z_max]-scaled cube
-                # ("real-world" coordinates)
-                # (k, j, i) are the indices of the voxel in the array
+    return _lookup_voxels_numpy(
+        _as_float32(x_lattice), _as_float32(y_lattice), _as_float32(z_lattice),
+        _as_float32(vectors),
+        _as_float32(centers), _as_float32(squared_radii)
+    )
 
-                # M_lattice is M in lattice coordinates
-                M_lattice = transfer_matrix @ M
 
-                # M_cell is M in real-world coordinates "modulo" the unit cell
-                M_cell = vectors.T @ (M_lattice - np.floor(M_lattice))
+def _as_float32(array: np.ndarray) -> np.ndarray:
+    """
+    Converts an array to single precision, and makes it C-contiguous for the lookup loops
+
+    Parameters
+    ----------
+    array: np.ndarray
+        The array to convert
 
-                # Since M_cell is in the unit cell, we can look it up
-                voxels[k, j, i] = lookup_voxel(M_cell, centers, squared_radii)
+    Returns
+    -------
+    np.ndarray
+        The converted array (or the array itself if it already was)
+    """
+    return np.ascontiguousarray(array, dtype=np.float32)
 
-    return voxels
+
+def _lookup_voxels_numpy(
+    x_lattice: np.ndarray,
+    y_lattice: np.ndarray,
+    z_lattice: np.ndarray,
+    vectors: np.ndarray,
+    centers: np.ndarray,
+    squared_radii: np.ndarray
+) -> np.ndarray:
+    """
+    Vectorized NumPy implementation of the voxel lookup, used when Numba is not available
+
+    Parameters
+    ----------
+    x_lattice: np.ndarray
+        Contribution of the X coordinates of the voxel centers to their lattice coordinates
+        (one row per X coordinate)
+    y_lattice: np.ndarray
+        Same as `x_lattice`, for the Y coordinates
+    z_lattice: np.ndarray
+        Same as `x_lattice`, for the Z coordinates
+    vectors: np.ndarray
+        Matrix formed by the vectors of the unit cell
+    centers: np.ndarray
+        Centers of the (augmented) atoms, one row per coordinate
+    squared_radii: np.ndarray
+        Squared radii of the (augmented) atoms
+
+    Returns
+    -------
+    np.ndarray
+        An array of voxels, indexed by (z, y, x)
+    """
+    # M_lattice holds the centers of the voxels in lattice coordinates, one row per voxel
+    M_lattice = (
+        z_lattice[:, None, None, :] + y_lattice[None, :, None, :] + x_lattice[None, None, :, :]
+    ).reshape(-1, 3)
+
+    # M_cell is M in real-world coordinates "modulo" the unit cell
+    M_cell = (M_lattice - np.floor(M_lattice)) @ vectors
+
+    # The voxels are sorted by X coordinate, so that the voxels inside the bounding boxes
+    # of a set of atoms (projected on the X axis) form a contiguous slab. Like the atom
+    # centers, M_cell is then transposed to one row per coordinate
+    voxel_order = np.argsort(M_cell[:, 0], kind='stable')
+    M_cell = np.ascontiguousarray(M_cell[voxel_order].T)
+    # (the radii are slightly enlarged so that rounding can only widen the slabs)
+    radii = np.sqrt(squared_radii) * np.float32(1 + 1e-5)
+    slab_starts = np.searchsorted(M_cell[0], centers[0] - radii, side='left')
+    slab_ends = np.searchsorted(M_cell[0], centers[0] + radii, side='right')
+
+    # Since M_cell is in the unit cell, we can look it up, one atom at a time and only over the
+    # voxels of its slab
+    sorted_counts = np.zeros(M_cell.shape[1], dtype=np.int16)
+    for atom in range(centers.shape[1]):
+        slab = slice(slab_starts[atom], slab_ends[atom])
+        squared_distances = _squared_distances(M_cell[:, slab], centers[:, atom, None])[:, 0]
+
+        # The boolean mask is added as is to the (int16) counts: this is much faster than
+        # counting along the rows, which goes through a temporary of native ints
+        sorted_counts[slab] += squared_distances <= squared_radii[atom]
+
+    counts = np.empty_like(sorted_counts)
+    counts[voxel_order] = sorted_counts
+    return counts.reshape(len(z_lattice), len(y_lattice), len(x_lattice))
+
+
+def _squared_distances(points: np.ndarray, centers: np.ndarray) -> np.ndarray:
+    """
+    Computes the squared distances between points and atom centers. The distances are
+    accumulated axis by axis in place, so that the only temporaries have the size of the
+    result (whereas broadcasting the differences would allocate several (n_points, n_atoms, 3)
+    arrays)
+
+    Parameters
+    ----------
+    points: np.ndarray
+        Coordinates of the points, one row per coordinate
+    centers: np.ndarray
+        Centers of the atoms, one row per coordinate
+
+    Returns
+    -------
+    np.ndarray
+        A (n_points, n_atoms) array of squared distances
+    """
+    # The distances are computed in the most precise type of the inputs (at least float32),
+    # whatever the type of the points: integer coordinates are valid points too
+    dtype = np.result_type(points, centers, np.float32)
+    squared_distances = np.zeros((points.shape[1], centers.shape[1]), dtype=dtype)
+    differences = np.empty_like(squared_distances)
+    for axis in range(3):
+        np.subtract(points[axis, :, None], centers[axis, None, :], out=differences)
+        differences *= differences
+        squared_distances += differences
+    return squared_distances
+
+
+def _count_containing_atoms(
+    m0: float,
+    m1: float,
+    m2: float,
+    centers: np.ndarray,
+    squared_radii: np.ndarray,
+    grid_origin: np.ndarray,
+    bucket_size: float,
+    grid_shape: np.ndarray,
+    bucket_starts: np.ndarray
+) -> int:
+    """
+    Counts the atoms containing a point of the unit cell, by only looking at the buckets
+    around the point. This function is not called as is, but compiled for both the CPU and
+    CUDA kernels.
+
+    Parameters
+    ----------
+    m0: float
+        X coordinate of the point
+    m1: float
+        Y coordinate of the point
+    m2: float
+        Z coordinate of the point
+    centers: np.ndarray
+        Centers of the atoms, sorted by bucket, one row per coordinate
+    squared_radii: np.ndarray
+        Squared radii of the atoms
+    grid_origin: np.ndarray
+        Coordinates of the origin of the grid
+    bucket_size: float
+        Size of the buckets
+    grid_shape: np.ndarray
+        Number of buckets on each axis
+    bucket_starts: np.ndarray
+        Index of the first atom of each bucket (see `hash_atoms`)
+
+    Returns
+    -------
+    int
+        The number of atoms in which the point resides
+    """
+    # Bucket of the point, and range of the neighbouring buckets on each axis
+    b0 = min(max(int((m0 - grid_origin[0]) / bucket_size), 0), grid_shape[0] - 1)
+    b1 = min(max(int((m1 - grid_origin[1]) / bucket_size), 0), grid_shape[1] - 1)
+    b2 = min(max(int((m2 - grid_origin[2]) / bucket_size), 0), grid_shape[2] - 1)
+    b2_first, b2_last = max(b2 - 1, 0), min(b2 + 1, grid_shape[2] - 1)
+
+    count = 0
+    for n0 in range(max(b0 - 1, 0), min(b0 + 2, grid_shape[0])):
+        for n1 in range(max(b1 - 1, 0), min(b1 + 2, grid_shape[1])):
+            # Buckets are stored with the last axis varying fastest, so the atoms
+            # of the three buckets along that axis are contiguous
+            row = (n0 * grid_shape[1] + n1) * grid_shape[2]
+            for atom in range(bucket_starts[row + b2_first], bucket_starts[row + b2_last + 1]):
+                dx = m0 - centers[0, atom]
+                dy = m1 - centers[1, atom]
+                dz = m2 - centers[2, atom]
+                count += (dx*dx + dy*dy + dz*dz) <= squared_radii[atom]
+    return count
+
+
+if HAS_NUMBA:
+    _count_containing_atoms_cpu = njit(fastmath=True, cache=True, nogil=True)(
+        _count_containing_atoms
+    )
+
+    # The kernel is compiled for the only types get_voxels calls it with, as soon as the module
+    # is imported: with the on-disk cache, compilation happens once and for all instead of on
+    # the first call of each process (i.e. when the user first changes a parameter in the app).
+    # The GIL is released so that the other threads of the app are not blocked during the
+    # computation; the other calls of the kernel still wait for it (see _KERNEL_LOCK)
+    @njit(  # type: ignore[misc]
+        'void(f4[:, ::1], f4[:, ::1], f4[:, ::1], f4[:, ::1], f4[:, ::1], f4[::1], '
+        'f4[::1], f4, i8[::1], i8[::1], i2[:, :, ::1])',
+        parallel=True, fastmath=True, cache=True, nogil=True
+    )
+    def _lookup_voxels_kernel(
+        x_lattice: np.ndarray,
+        y_lattice: np.ndarray,
+        z_lattice: np.ndarray,
+        vectors_T: np.ndarray,
+        centers: np.ndarray,
+        squared_radii: np.ndarray,
+        grid_origin: np.ndarray,
+        bucket_size: float,
+        grid_shape: np.ndarray,
+        bucket_starts: np.ndarray,
+        voxels: np.ndarray
+    ) -> None:
+        """
+        Compiled implementation of the voxel lookup: fills `voxels` (indexed by (z, y, x))
+        in place. The parameters are the same as for `_lookup_voxels_numpy`, except that
+        the matrix of the unit cell vectors is transposed, and that the atoms are sorted
+        into buckets (see `hash_atoms`).
+        """
+        # pylint: disable=invalid-name, not-an-iterable
+        for k in prange(len(z_lattice)):
+            for j in range(len(y_lattice)):
+                # The contributions of y and z are the same for the whole row
+                yz0 = y_lattice[j, 0] + z_lattice[k, 0]
+                yz1 = y_lattice[j, 1] + z_lattice[k, 1]
+                yz2 = y_lattice[j, 2] + z_lattice[k, 2]
+                for i in range(len(x_lattice)):
+                    # Same as in the NumPy version, with scalars instead of arrays:
+                    # M_lattice (fractional part only) then M_cell
+                    l0 = x_lattice[i, 0] + yz0
+                    l1 = x_lattice[i, 1] + yz1
+                    l2 = x_lattice[i, 2] + yz2
+                    l0 -= np.floor(l0)
+                    l1 -= np.floor(l1)
+                    l2 -= np.floor(l2)
+                    m0 = vectors_T[0, 0] * l0 + vectors_T[0, 1] * l1 + vectors_T[0, 2] * l2
+                    m1 = vectors_T[1, 0] * l0 + vectors_T[1, 1] * l1 + vectors_T[1, 2] * l2
+                    m2 = vectors_T[2, 0] * l0 + vectors_T[2, 1] * l1 + vectors_T[2, 2] * l2
+
+                    voxels[k, j, i] = _count_containing_atoms_cpu(
+                        m0, m1, m2,
+                        centers, squared_radii,
+                        grid_origin, bucket_size, grid_shape, bucket_starts
+                    )
+
+
+if HAS_CUDA:
+    _count_containing_atoms_gpu = cuda.jit(device=True)(_count_containing_atoms)
+
+    @cuda.jit(fastmath=True)  # type: ignore[misc]
+    def _lookup_voxels_cuda_kernel(
+        x_lattice: np.ndarray,
+        y_lattice: np.ndarray,
+        z_lattice: np.ndarray,
+        vectors_T: np.ndarray,
+        centers: np.ndarray,
+        squared_radii: np.ndarray,
+        grid_origin: np.ndarray,
+        bucket_size: float,
+        grid_shape: np.ndarray,
+        bucket_starts: np.ndarray,
+        voxels: np.ndarray
+    ) -> None:
+        """
+        CUDA version of `_lookup_voxels_kernel`, with one thread per voxel
+        """
+        # pylint: disable=invalid-name, no-value-for-parameter
+        # The X axis varies fastest among the threads, as in the memory layout of the voxels
+        i, j, k = cuda.grid(3)
+        if i >= len(x_lattice) or j >= len(y_lattice) or k >= len(z_lattice):
+            return
+
+        l0 = x_lattice[i, 0] + y_lattice[j, 0] + z_lattice[k, 0]
+        l1 = x_lattice[i, 1] + y_lattice[j, 1] + z_lattice[k, 1]
+        l2 = x_lattice[i, 2] + y_lattice[j, 2] + z_lattice[k, 2]
+        l0 -= math.floor(l0)
+        l1 -= math.floor(l1)
+        l2 -= math.floor(l2)
+        m0 = vectors_T[0, 0] * l0 + vectors_T[0, 1] * l1 + vectors_T[0, 2] * l2
+        m1 = vectors_T[1, 0] * l0 + vectors_T[1, 1] * l1 + vectors_T[1, 2] * l2
+        m2 = vectors_T[2, 0] * l0 + vectors_T[2, 1] * l1 + vectors_T[2, 2] * l2
+
+        voxels[k, j, i] = _count_containing_atoms_gpu(
+            m0, m1, m2,
+            centers, squared_radii,
+            grid_origin, bucket_size, grid_shape, bucket_starts
+        )
+
+
+def _lookup_voxels_cuda(
+    x_lattice: np.ndarray,
+    y_lattice: np.ndarray,
+    z_lattice: np.ndarray,
+    *arguments: np.ndarray
+) -> np.ndarray:
+    """
+    Runs the CUDA kernel on the GPU and brings the voxels back to the host
+
+    Parameters
+    ----------
+    x_lattice: np.ndarray
+        Contribution of the X coordinates of the voxel centers to their lattice coordinates
+    y_lattice: np.ndarray
+        Same as `x_lattice`, for the Y coordinates
+    z_lattice: np.ndarray
+        Same as `x_lattice`, for the Z coordinates
+    arguments: np.ndarray
+        The other arguments of `_lookup_voxels_kernel`, except the voxels
+
+    Returns
+    -------
+    np.ndarray
+        An array of voxels, indexed by (z, y, x)
+    """
+    shape = (len(z_lattice), len(y_lattice), len(x_lattice))
+    voxels = cuda.device_array(shape, dtype=np.int16)
+
+    # The kernel indexes the threads as (x, y, z), the other way around from the voxels
+    blocks_per_grid = tuple(
+        (size + block_size - 1) // block_size
+        for size, block_size in zip(shape[::-1], CUDA_BLOCK_SHAPE)
+    )
+    device_arguments = [
+        cuda.to_device(argument) if isinstance(argument, np.ndarray) else argument
+        for argument in (x_lattice, y_lattice, z_lattice, *arguments)
+    ]
+    _lookup_voxels_cuda_kernel[blocks_per_grid, CUDA_BLOCK_SHAPE](*device_arguments, voxels)
+
+    return voxels.copy_to_host()
 
 
 def repeat_once(
@@ -97,14 +461,87 @@ def repeat_once(
         The atoms with their copies (kinds are discarded)
     """
     _, centers, radii = atoms
-    v1, v2, v3 = vectors
+    centers, radii = np.asarray(centers).reshape(-1, 3), np.asarray(radii)
+
+    # One shift per copy (27 x 3), in the order (k1, k2, k3) of it.product. The copies are
+    # stacked shift by shift
     repetition = range(-1, 2)
-    centers_augmented, radii_augmented = [], []
-    for k1, k2, k3 in it.product(repetition, repetition, repetition):
-        for center, radius in zip(centers, radii):
-            centers_augmented.append(center + k1 * v1 + k2 * v2 + k3 * v3)
-            radii_augmented.append(radius)
-    return np.array(centers_augmented), np.array(radii_augmented)
+    shifts = np.array(list(it.product(repetition, repetition, repetition))) @ vectors
+    centers_augmented = (shifts[:, None, :] + centers[None, :, :]).reshape(-1, 3)
+    radii_augmented = np.tile(radii, len(shifts))
+    return centers_augmented, radii_augmented
+
+
+def hash_atoms(
+    centers: np.ndarray,
+    radii: np.ndarray,
+    vectors: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, float, np.ndarray, np.ndarray]:
+    """
+    Sorts the atoms into a uniform grid of cubic buckets covering the unit cell. The size of
+    the buckets is the largest radius, so that a point can only be contained in atoms
+    from its own bucket or the 26 neighbouring ones. Atoms that cannot reach the unit cell
+    are discarded: for the copies made by `repeat_once`, only the ones near the faces of the
+    unit cell remain.
+
+    When there are too few buckets to gain anything, a single bucket is used.
+
+    Parameters
+    ----------
+    centers: np.ndarray
+        Centers of the atoms
+    radii: np.ndarray
+        Radii of the atoms
+    vectors: np.ndarray
+        Matrix formed by the vectors of the unit cell
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray, float, np.ndarray, np.ndarray]:
+        - the centers of the remaining atoms, sorted by bucket
+        - their radii
+        - the coordinates of the origin of the grid
+        - the size of the buckets
+        - the number of buckets on each axis
+        - the index of the first atom of each bucket (buckets are ordered with the last axis
+          varying fastest), plus a final index one past the last atom
+    """
+    bucket_size = float(radii.max()) if len(radii) else 1.
+
+    # Bounding box of the unit cell, extended by the largest radius
+    corners = np.array(list(it.product([0, 1], repeat=3))) @ vectors
+    grid_origin = corners.min(axis=0) - bucket_size
+    grid_end = corners.max(axis=0) + bucket_size
+
+    # An atom can reach the unit cell only if it is close enough to the grid, and to the slab
+    # between each pair of opposite faces of the cell. The fractional coordinates give the
+    # position within the slabs, and the norm of the reciprocal vectors (columns of the inverse
+    # matrix) converts the radii to the same scale. For skewed cells this is much more
+    # selective than the bounding box
+    reciprocal_vectors = np.linalg.inv(vectors)
+    fractional_centers = centers @ reciprocal_vectors
+    margins = radii[:, None] * np.linalg.norm(reciprocal_vectors, axis=0)
+    inside = np.all(
+        (centers >= grid_origin) & (centers <= grid_end)
+        & (fractional_centers >= -margins) & (fractional_centers <= 1 + margins),
+        axis=1
+    )
+    centers, radii = centers[inside], radii[inside]
+
+    grid_shape = np.maximum(np.ceil((grid_end - grid_origin) / bucket_size), 1).astype(np.int64)
+    if grid_shape.prod() <= 27:
+        bucket_size = float((grid_end - grid_origin).max())
+        grid_shape = np.ones(3, dtype=np.int64)
+
+    keys = np.floor((centers - grid_origin) / bucket_size).astype(np.int64)
+    keys = np.clip(keys, 0, grid_shape - 1)
+    buckets = (keys[:, 0] * grid_shape[1] + keys[:, 1]) * grid_shape[2] + keys[:, 2]
+
+    order = np.argsort(buckets, kind='stable')
+    counts = np.bincount(buckets, minlength=grid_shape.prod())
+    bucket_starts = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    return centers[order], radii[order], grid_origin, bucket_size, grid_shape, bucket_starts
 
 
 def lookup_voxel(M_cell: np.ndarray, centers: np.ndarray, squared_radii:np.ndarray) -> float:
@@ -127,5 +564,5 @@ def lookup_voxel(M_cell: np.ndarray, centers: np.ndarray, squared_radii:np.ndarr
     float
         The number of atoms in which M_cell resides
     """
-    squared_distances = ((M_cell - centers)**2).sum(axis=1)
-    return (squared_distances <= squared_radii).sum()
+    squared_distances = _squared_distances(M_cell[:, None], centers.T)[0]
+    return np.count_nonzero(squared_distances <= squared_radii)
@@ -84,6 +84,78 @@ def get_xyz_files(directory: str) -> List[str]:
     return sorted(map(basename, filenames))
 
 
+@st.cache # type: ignore[misc]
+def load_xyz(
+    xyz_path: str,
+    mtime: float
+) -> Tuple[Tuple[np.ndarray, np.ndarray, np.ndarray], np.ndarray]:
+    """
+    Reads an XYZ file (see `read_xyz`), caching the result across reruns of the app
+
+    Parameters
+    ----------
+    xyz_path: str
+        Path of the file to read
+    mtime: float
+        Last modification time of the file. It is not used, except by the cache to detect
+        that the file has changed
+
+    Returns
+    -------
+    Tuple[Tuple[np.ndarray, np.ndarray, np.ndarray], np.ndarray]:
+        Kinds + atom centers + their radii, and matrix formed by the vectors of the unit cell
+    """
+    with open(xyz_path, 'r', encoding='utf-8') as xyz_file:
+        return read_xyz(xyz_file)
+
+
+@st.cache( # type: ignore[misc]
+    hash_funcs={np.ndarray: lambda array: array.tobytes()},
+    allow_output_mutation=True
+)
+def compute_voxels(
+    method_name: str,
+    atoms: Tuple[np.ndarray, np.ndarray, np.ndarray],
+    vectors: np.ndarray,
+    resolution: int,
+    x_max: float,
+    y_max: float,
+    z_max: float
+) -> np.ndarray:
+    """
+    Calls the preprocessing method, caching the voxels so that changing only the rendering
+    parameters (or coming back to previous values) does not compute them again
+
+    Parameters
+    ----------
+    method_name: str
+        Preprocessing method to use
+    atoms: Tuple[np.ndarray, np.ndarray, np.ndarray]
+        Kinds + atom centers + their radii
+    vectors: np.ndarray
+        Matrix formed by the vectors of the unit cell
+    resolution: int
+        Number of voxels in each direction
+    x_max: float
+        Maximum X coordinate of the cube
+    y_max: float
+        Maximum Y coordinate of the cube
+    z_max: float
+        Maximum Z coordinate of the cube
+
+    Returns
+    -------
+    np.ndarray
+        An array of voxels
+    """
+    return preprocessing.METHODS[method_name].get_voxels( # type: ignore[attr-defined]
+        atoms,
+        vectors,
+        resolution,
+        x_max, y_max, z_max
+    )
+
+
 @st.cache # type: ignore[misc]
 def get_monochrome_transfer_function() -> ipv.TransferFunction:
     """
@@ -146,8 +218,7 @@ def run_app(directory: str) -> None:
     )
 
     xyz_path = os.path.abspath(os.path.join(directory, filename))
-    with open(xyz_path, 'r', encoding='utf-8') as xyz_file:
-        atoms, vectors = read_xyz(xyz_file)
+    atoms, vectors = load_xyz(xyz_path, os.path.getmtime(xyz_path))
 
     n_atoms = len(atoms[0])
     st.title(f'{filename} - {n_atoms} atoms')
@@ -196,9 +267,15 @@ def render_structure(
     for vector in vectors:
         plotter.add_mesh(pv.Arrow(direction=vector, **axes_properties), color='red')
 
-    for kind, center, radius in zip(*atoms):
+    # All the atoms of a kind are rendered as a single mesh, by scaling copies (glyphs) of a
+    # unit sphere: the number of meshes does not depend on the number of atoms
+    kinds, centers, radii = atoms
+    for kind in np.unique(kinds):
+        selected = kinds == kind
+        points = pv.PolyData(centers[selected])
+        points['radius'] = radii[selected]
         plotter.add_mesh(
-            pv.Sphere(radius, center),
+            points.glyph(geom=pv.Sphere(radius=1), scale='radius', orient=False),
             color=ATOM_COLORS[color_scheme][kind],
         )
 
@@ -242,7 +319,8 @@ def render_voxels(
     z_max: float
         Maximum Z coordinate of the cube
     """
-    voxels = preprocessing.METHODS[method_name].get_voxels( # type: ignore[attr-defined]
+    voxels = compute_voxels(
+        method_name,
         atoms,
         vectors,
         resolution,
@@ -1,7 +1,10 @@
+import threading
 import unittest
+from unittest import mock
 
 import numpy as np
 
+from crystalz.preprocessing import overlaps
 from crystalz.preprocessing.overlaps import *
 
 
@@ -38,3 +41,116 @@ class TestOverlaps(unittest.TestCase):
 
         np.testing.assert_allclose(expected_radii, radii_augmented)
         np.testing.assert_allclose(expected_centers, centers_augmented)
+
+    def test_voxels_match_pointwise_lookup(self):
+        centers = np.array([
+            [1, 1, 1],
+            [2.5, .5, 3],
+            [3.9, 3.8, .1],
+        ])
+        radii = np.array([1.5, 1, 2])
+        atoms = np.array(['Al', 'O', 'In']), centers, radii
+        vectors = np.array([
+            [4, 1, 0],
+            [0, 4, 1],
+            [1, 0, 4]
+        ])
+        resolution = 8
+        x_max, y_max, z_max = 6, 7, 8
+
+        # Straightforward (and slow) voxel by voxel computation
+        centers_augmented, radii_augmented = repeat_once(atoms, vectors)
+        transfer_matrix = np.linalg.inv(vectors).T
+        expected_voxels = np.zeros((resolution, resolution, resolution))
+        for i in range(resolution):
+            for j in range(resolution):
+                for k in range(resolution):
+                    M = (np.array([i, j, k]) + .5) * np.array([x_max, y_max, z_max]) / resolution
+                    M_lattice = transfer_matrix @ M
+                    M_cell = vectors.T @ (M_lattice - np.floor(M_lattice))
+                    expected_voxels[k, j, i] = lookup_voxel(
+                        M_cell, centers_augmented, radii_augmented**2
+                    )
+
+        # All the implementations available are checked: NumPy, and Numba for the CPU and GPU
+        backends = sorted({
+            (False, False),
+            (overlaps.HAS_NUMBA, False),
+            (overlaps.HAS_NUMBA, overlaps.HAS_CUDA)
+        })
+        for has_numba, has_cuda in backends:
+            with self.subTest(has_numba=has_numba, has_cuda=has_cuda), \
+                    mock.patch.object(overlaps, 'HAS_NUMBA', has_numba), \
+                    mock.patch.object(overlaps, 'HAS_CUDA', has_cuda):
+                voxels = get_voxels(atoms, vectors, resolution, x_max, y_max, z_max)
+
+                self.assertEqual((resolution, resolution, resolution), voxels.shape)
+                np.testing.assert_equal(expected_voxels, voxels)
+
+    def test_concurrent_voxel_computations(self):
+        # Streamlit runs each session in its own thread, so the voxels can be computed by
+        # several threads at the same time; they must all get the same result as a single call
+        centers = np.array([
+            [1, 1, 1],
+            [2.5, .5, 3],
+        ])
+        radii = np.array([1.5, 1])
+        atoms = np.array(['Al', 'O']), centers, radii
+        vectors = np.array([
+            [4, 1, 0],
+            [0, 4, 1],
+            [1, 0, 4]
+        ])
+        arguments = atoms, vectors, 32, 5, 5, 5
+        expected_voxels = get_voxels(*arguments)
+
+        results = [None] * 4
+
+        def compute(index):
+            results[index] = get_voxels(*arguments)
+
+        threads = [threading.Thread(target=compute, args=(index,)) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for voxels in results:
+            np.testing.assert_equal(expected_voxels, voxels)
+
+    def test_hashing_keeps_only_atoms_reaching_the_cell(self):
+        # With these radii, only the original atoms and the copy of the second one shifted
+        # along +X can reach the unit cell
+        centers = np.array([
+            [5, 5, 5],
+            [.5, 5, 5],
+        ])
+        radii = np.array([1, 1])
+        atoms = 'Kinds are ignored', centers, radii
+        vectors = np.array([
+            [10, 0, 0],
+            [0, 10, 0],
+            [0, 0, 10]
+        ])
+
+        centers_augmented, radii_augmented = repeat_once(atoms, vectors)
+        centers_hashed, radii_hashed, _, _, _, bucket_starts = hash_atoms(
+            centers_augmented, radii_augmented, vectors
+        )
+
+        expected_centers = [[.5, 5, 5], [5, 5, 5], [10.5, 5, 5]]
+        np.testing.assert_allclose(expected_centers, sorted(centers_hashed.tolist()))
+        np.testing.assert_allclose([1, 1, 1], radii_hashed)
+        self.assertEqual(len(centers_hashed), bucket_starts[-1])
+
+    def test_lookup_of_an_integer_point(self):
+        centers = np.array([
+            [0, 0, .5],
+            [3, 0, 0],
+        ])
+        squared_radii = np.array([1, 1])
+
+        self.assertEqual(1, lookup_voxel(np.array([0, 0, 0]), centers, squared_radii))
+        float32_point = np.array([0, 0, 0], dtype=np.float32)
+        self.assertEqual(1, lookup_voxel(float32_point, centers, squared_radii))
+        self.assertEqual(0, lookup_voxel(np.array([0, 0, 2]), centers, squared_radii))
@@ -42,3 +42,27 @@ class TestXYZ(unittest.TestCase):
         ])
         np.testing.assert_allclose(radii, [1.84, 1.93, 1.93, 1.87, 1.52, 1.52])
         np.testing.assert_allclose(vectors, [[1, -2, 3], [4, -5, 6], [7, -8, 9]])
+
+    def test_reading_a_malformed_xyz_file_fails(self):
+        xyz_contents = '''
+            lattice_vector 1 -2 3
+            lattice_vector 4 -5 6
+            lattice_vector 7 -8 9
+
+            atom 1.1 1.2 1.3 Al
+            atom 2.1 2.2 In
+        '''
+        with self.assertRaises(ValueError):
+            read_xyz(io.StringIO(xyz_contents))
+
+    def test_reading_an_unknown_kind_of_atom_fails(self):
+        xyz_contents = '''
+            lattice_vector 1 -2 3
+            lattice_vector 4 -5 6
+            lattice_vector 7 -8 9
+
+            atom 1.1 1.2 1.3 Al
+            atom 2.1 2.2 2.3 Xx
+        '''
+        with self.assertRaises(KeyError):
+            read_xyz(io.StringIO(xyz_contents))